@@ -1,25 +1,165 @@
 import os
+import asyncio
+from contextlib import asynccontextmanager
+import hashlib
+import logging
+import httpx
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from supabase import create_client, Client
 import google.generativeai as genai
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 
-app = FastAPI()
+# One pooled HTTP/2 client for all PostgREST calls, so TCP/TLS setup is paid
+# once instead of on every request.
+supabase_http = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/rest/v1",
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+    timeout=5.0,
+    headers={
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+    },
+)
+
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# The fixed instructions go in the system prompt, separate from the chat log
+# that is sent with each call.
+SUMMARY_SYSTEM_PROMPT = (
+    "You are a helpful assistant for a streamer. "
+    "You will be given the chat log from the last few minutes. "
+    "Summarize what happened in 2-3 short, funny sentences. "
+    "Highlight if anyone subscribed or if there was drama."
+)
+PROMPT_PREFIX = "CHAT LOG:\n"
 
+# Built once and reused for every call; a 2-3 sentence summary never needs
+# more than a couple hundred tokens.
+GEN_CFG = genai.types.GenerationConfig(max_output_tokens=200, temperature=0.7)
 
 genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-flash-lite')
+model = genai.GenerativeModel(
+    'gemini-2.5-flash-lite',
+    system_instruction=SUMMARY_SYSTEM_PROMPT,
+    generation_config=GEN_CFG,
+)
+
+
+async def sb_insert(table: str, data):
+    # Callers never read the inserted rows back, so don't ask for them
+    response = await supabase_http.post(
+        f"/{table}", json=data, headers={"Prefer": "return=minimal"}
+    )
+    response.raise_for_status()
+
+
+async def sb_recent_chat(limit: int = 50):
+    """Returns the newest `limit` chat messages, newest first."""
+    response = await supabase_http.get(
+        "/chat_messages",
+        params={
+            "select": "username,message_text",
+            # Rows from one batch insert share created_at; id keeps them in order
+            "order": "created_at.desc,id.desc",
+            "limit": limit,
+        },
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+async def sb_latest_chat_id():
+    """Returns the id of the newest chat message, or None if there are none."""
+    response = await supabase_http.get(
+        "/chat_messages",
+        params={"select": "id", "order": "id.desc", "limit": 1},
+    )
+    response.raise_for_status()
+    rows = response.json()
+    return rows[0]["id"] if rows else None
+
+
+# Recent summaries keyed by a hash of the chat log they were generated from,
+# so polling an unchanged chat doesn't call Gemini again.
+summary_cache: TTLCache = TTLCache(maxsize=256, ttl=30)
+
+
+# The newest message id the last summary was built from. While it
+# hasn't moved, the chat hasn't changed and the summary can be reused as-is.
+last_summary = {"watermark": None, "text": None}
+
+
+def chat_log_key(chat_log: str) -> str:
+    return hashlib.blake2b(chat_log.encode(), digest_size=16).hexdigest()
+
+
+def etag_for(watermark) -> str:
+    return f'"{hashlib.blake2b(str(watermark).encode(), digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # Weak comparison: W/ prefixes are ignored and "*" matches any tag
+    if not if_none_match:
+        return False
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag == "*" or tag.removeprefix("W/") == etag for tag in tags)
+
+
+async def fetch_chat_log() -> str:
+    """
+    Returns the last 50 chat messages as "username: message" lines,
+    oldest first. Empty string if the chat is quiet.
+    """
+    data = await sb_recent_chat(50)
+    # We reverse it so the AI reads chronologically (Old -> New)
+    return "\n".join([f"{msg['username']}: {msg['message_text']}" for msg in reversed(data)])
+
+
+QUIET_SUMMARY = "Chat has been quiet. Nothing to report!"
+
+
+async def prepare_summary(watermark):
+    """
+    Shared by both summary endpoints. Given the newest message id,
+    returns (summary, chat_log): a summary that can be served as-is
+    (cached, or the quiet message), or the chat log Gemini should summarize.
+    """
+    if watermark is None:
+        return QUIET_SUMMARY, None
+    if last_summary["watermark"] == watermark:
+        return last_summary["text"], None
+
+    chat_log = await fetch_chat_log()
+    if not chat_log:
+        return QUIET_SUMMARY, None
+
+    cached = summary_cache.get(chat_log_key(chat_log))
+    if cached is not None:
+        last_summary.update(watermark=watermark, text=cached)
+        return cached, None
+    return None, chat_log
+
+
+def remember_summary(watermark, chat_log: str, summary: str):
+    summary_cache[chat_log_key(chat_log)] = summary
+    last_summary.update(watermark=watermark, text=summary)
+
+
+def sse_event(text: str) -> str:
+    # Every line of a multi-line payload needs its own "data:" prefix
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
 
 
 class BroadcastRequest(BaseModel):
@@ -27,49 +167,257 @@ class BroadcastRequest(BaseModel):
     username: str
 
 
+# Chat rows waiting to be written by chat_flusher. The queue is bounded so a
+# chat raid can't grow memory without limit; when full, the oldest row goes.
+CHAT_BATCH_SIZE = 50
+CHAT_BATCH_WAIT = 0.2  # seconds
+CHAT_QUEUE_SIZE = 5000
+CHAT_DRAIN_TIMEOUT = 10  # seconds shutdown may spend writing out the queue
+chat_write_queue: asyncio.Queue = asyncio.Queue(maxsize=CHAT_QUEUE_SIZE)
+# Set on shutdown so no new rows are accepted while the queue drains
+chat_writes_closed = asyncio.Event()
+
+
+def enqueue_chat(row):
+    try:
+        chat_write_queue.put_nowait(row)
+    except asyncio.QueueFull:
+        dropped = chat_write_queue.get_nowait()
+        chat_write_queue.task_done()
+        logger.warning("Chat write queue full, dropped oldest message from %s", dropped.get("username"))
+        chat_write_queue.put_nowait(row)
+
+
+def chat_writes_available() -> bool:
+    # A restarting flusher will still drain the queue; a degraded one won't
+    if chat_writes_closed.is_set():
+        return False
+    return worker_status.get("chat_flusher") in ("running", "restarting")
+
+
+async def chat_flusher():
+    """
+    Drains chat_write_queue in micro-batches (up to CHAT_BATCH_SIZE rows or
+    CHAT_BATCH_WAIT seconds) and writes each batch with one multi-row insert.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await chat_write_queue.get()]
+        # asyncio.timeout cancels get() in place; wait_for could swallow a
+        # shutdown cancel if get() had already returned
+        try:
+            async with asyncio.timeout_at(loop.time() + CHAT_BATCH_WAIT):
+                while len(batch) < CHAT_BATCH_SIZE:
+                    batch.append(await chat_write_queue.get())
+        except TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Nothing was sent yet, so hand the rows back for the shutdown drain
+            for row in batch:
+                chat_write_queue.task_done()
+                enqueue_chat(row)
+            raise
+
+        try:
+            await sb_insert("chat_messages", batch)
+        except asyncio.CancelledError:
+            # The insert may or may not have landed; retrying could duplicate it
+            logger.warning("Abandoned %d chat messages mid-insert on shutdown", len(batch))
+            raise
+        except Exception as e:
+            logger.warning("Dropped %d chat messages: %s", len(batch), e)
+        finally:
+            for _ in batch:
+                chat_write_queue.task_done()
+
+
+async def drain_chat_queue(deadline: float):
+    """
+    Writes whatever is still queued directly. Used on shutdown, so it gives
+    up at `deadline` (loop time) or on the first failed insert.
+    """
+    batch = []
+    try:
+        async with asyncio.timeout_at(deadline):
+            while not chat_write_queue.empty():
+                count = min(CHAT_BATCH_SIZE, chat_write_queue.qsize())
+                batch = [chat_write_queue.get_nowait() for _ in range(count)]
+                await sb_insert("chat_messages", batch)
+                batch = []
+    except Exception as e:
+        abandoned = len(batch) + chat_write_queue.qsize()
+        logger.warning("Abandoned %d queued chat messages on shutdown: %r", abandoned, e)
+
+
+# Long-running tasks started with the app, by name.
+BACKGROUND_WORKERS = {
+    "chat_flusher": chat_flusher,
+}
+# A worker that crashes this many times within the window is given up on
+# and reported as degraded on /health instead of restarting forever.
+WORKER_MAX_FAILURES = 5
+WORKER_FAILURE_WINDOW = 300  # seconds
+WORKER_SHUTDOWN_TIMEOUT = 5  # seconds
+worker_status = {}
+
+
+async def supervise(name, worker):
+    """
+    Runs a background worker, restarting it with exponential backoff
+    (capped at 60s) whenever it crashes.
+    """
+    loop = asyncio.get_running_loop()
+    failures = []
+    while True:
+        worker_status[name] = "running"
+        try:
+            await worker()
+            worker_status[name] = "stopped"
+            return
+        except Exception:
+            now = loop.time()
+            failures = [t for t in failures if now - t < WORKER_FAILURE_WINDOW] + [now]
+            if len(failures) >= WORKER_MAX_FAILURES:
+                worker_status[name] = "degraded"
+                logger.exception("%s keeps crashing, giving up", name)
+                return
+            worker_status[name] = "restarting"
+            logger.exception("%s crashed, restarting", name)
+            await asyncio.sleep(min(60, 2 ** len(failures)))
+
+
+async def run_background_workers():
+    async with asyncio.TaskGroup() as tg:
+        for name, worker in BACKGROUND_WORKERS.items():
+            tg.create_task(supervise(name, worker))
+
+
+async def warm_up_gemini():
+    # Open the Gemini channel now so the first /summarize isn't slowed down
+    try:
+        await model.generate_content_async(
+            "ping",
+            generation_config={"max_output_tokens": 1},
+            request_options={"timeout": 5},
+        )
+    except Exception as e:
+        logger.warning("Gemini warmup failed: %s", e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep a reference so the task isn't garbage collected mid-flight
+    app.state.workers = asyncio.create_task(run_background_workers())
+
+    # Runs in the background so a slow Gemini never holds up serving requests
+    app.state.gemini_warmup = asyncio.create_task(warm_up_gemini())
+
+    yield
+
+    app.state.gemini_warmup.cancel()
+    await asyncio.wait({app.state.gemini_warmup}, timeout=1)
+
+    # Stop taking new rows and give the flusher a chance to write the rest.
+    # The flusher and the direct drain below share one deadline.
+    chat_writes_closed.set()
+    drain_deadline = asyncio.get_running_loop().time() + CHAT_DRAIN_TIMEOUT
+    if worker_status.get("chat_flusher") in ("running", "restarting"):
+        try:
+            async with asyncio.timeout_at(drain_deadline):
+                await chat_write_queue.join()
+        except TimeoutError:
+            logger.warning("Chat flusher didn't drain the queue in time")
+
+    app.state.workers.cancel()
+    # Let the workers finish cancelling before their HTTP client goes away
+    _, pending = await asyncio.wait({app.state.workers}, timeout=WORKER_SHUTDOWN_TIMEOUT)
+    if pending:
+        logger.warning("Background workers didn't stop within %ss", WORKER_SHUTDOWN_TIMEOUT)
+    # Anything the flusher couldn't get to is written directly
+    await drain_chat_queue(drain_deadline)
+    await supabase_http.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
 
 @app.get("/")
 def read_root():
     return {"status": "StreamLine Brain is Online 🧠"}
 
+@app.get("/health")
+def health(response: Response):
+    # A worker that is only restarting after a crash is still healthy
+    degraded = any(status in ("degraded", "stopped") for status in worker_status.values())
+    if degraded:
+        response.status_code = 503
+    return {"status": "degraded" if degraded else "ok", "workers": worker_status}
+
 @app.get("/summarize")
-async def get_summary():
+async def get_summary(response: Response, if_none_match: str | None = Header(default=None)):
     """
-    1. Fetches the last 50 chat messages from Supabase.
-    2. Sends them to Gemini to summarize.
+    1. Checks whether any chat message arrived since the last summary.
+    2. Fetches the last 50 chat messages from Supabase.
+    3. Sends them to Gemini to summarize.
+
+    The ETag identifies the newest message, so the app can poll with
+    If-None-Match and get a 304 while the chat is unchanged.
     """
     try:
-        # A. Fetch chat logs (Newest first)
-        response = supabase.table("chat_messages")\
-            .select("username, message_text")\
-            .order("created_at", desc=True)\
-            .limit(50)\
-            .execute()
-        
-        data = response.data
-        if not data:
-            return {"summary": "Chat has been quiet. Nothing to report!"}
-
-        # B. Format for AI
-        # We reverse it so the AI reads chronologically (Old -> New)
-        chat_log = "\n".join([f"{msg['username']}: {msg['message_text']}" for msg in reversed(data)])
-
-        # C. Prompt Engineering
-        prompt = (
-            "You are a helpful assistant for a streamer. "
-            "Here is the chat log from the last few minutes. "
-            "Summarize what happened in 2-3 short, funny sentences. "
-            "Highlight if anyone subscribed or if there was drama.\n\n"
-            f"CHAT LOG:\n{chat_log}"
-        )
+        # A. Short-circuit if nothing new was said
+        watermark = await sb_latest_chat_id()
+        etag = etag_for(watermark) if watermark is not None else None
+        if etag and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
 
-        # D. Generate
-        result = model.generate_content(prompt)
-        return {"summary": result.text}
+        # B. Reuse a summary, or fetch the chat log to summarize
+        summary, chat_log = await prepare_summary(watermark)
+
+        if summary is None:
+            # C. Generate (instructions are already in the system prompt)
+            result = await model.generate_content_async(PROMPT_PREFIX + chat_log)
+            summary = result.text
+            remember_summary(watermark, chat_log, summary)
+
+        if etag:
+            response.headers["ETag"] = etag
+        return {"summary": summary}
 
     except Exception as e:
         return {"summary": f"AI Brain Freeze: {str(e)}"}
 
+@app.get("/summarize/stream")
+async def stream_summary():
+    """
+    Same as /summarize, but streams the summary as Server-Sent Events
+    while Gemini is still generating it, so the app can render it early.
+    """
+    async def events():
+        try:
+            watermark = await sb_latest_chat_id()
+            summary, chat_log = await prepare_summary(watermark)
+            if summary is not None:
+                yield sse_event(summary)
+                return
+
+            response = await model.generate_content_async(PROMPT_PREFIX + chat_log, stream=True)
+            parts = []
+            async for chunk in response:
+                if not chunk.parts:
+                    continue
+                parts.append(chunk.text)
+                yield sse_event(chunk.text)
+            if not parts:
+                # Blocked or empty response; don't cache it for this watermark
+                yield sse_event("AI Brain Freeze: Gemini returned an empty summary")
+                return
+            remember_summary(watermark, chat_log, "".join(parts))
+
+        except Exception as e:
+            yield sse_event(f"AI Brain Freeze: {str(e)}")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.post("/broadcast")
 async def broadcast_message(req: BroadcastRequest):
     """
@@ -77,6 +425,10 @@ async def broadcast_message(req: BroadcastRequest):
     For now, it just saves it back to Supabase so it appears in the feed.
     Later, you add Twitch/YouTube API calls here.
     """
+    # Don't ack a message nothing is going to write
+    if not chat_writes_available():
+        raise HTTPException(status_code=503, detail="Chat writes are unavailable")
+
     try:
         # 1. (Future) Send to Twitch API...
         # 2. (Future) Send to YouTube API...
@@ -88,8 +440,9 @@ async def broadcast_message(req: BroadcastRequest):
             "platform": "twitch", # Defaulting to Twitch for MVP
             "is_subscriber": True # The streamer is always a sub!
         }
-        supabase.table("chat_messages").insert(data).execute()
-        
-        return {"status": "sent", "message": req.message}
+        # Written in the background by chat_flusher
+        enqueue_chat(data)
+
+        return {"status": "queued", "message": req.message}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
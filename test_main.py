@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+
+# main builds its clients at import time, so give it dummy settings
+os.environ.setdefault("SUPABASE_URL", "http://supabase.test")
+os.environ.setdefault("SUPABASE_KEY", "test-key")
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import pytest
+from fastapi import Response
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    # asyncio primitives bind to the first loop that uses them, and each
+    # test runs its own loop
+    monkeypatch.setattr(main, "chat_write_queue", asyncio.Queue(maxsize=main.CHAT_QUEUE_SIZE))
+    monkeypatch.setattr(main, "chat_writes_closed", asyncio.Event())
+    monkeypatch.setattr(main, "worker_status", {})
+
+
+# ETags
+
+def test_etag_for_is_quoted_and_stable():
+    etag = main.etag_for(42)
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == main.etag_for(42) == main.etag_for("42")
+    assert etag != main.etag_for(43)
+
+
+@pytest.mark.parametrize("header", [
+    "{etag}",
+    "W/{etag}",
+    '"other", {etag}',
+    '"other",W/{etag}',
+    "*",
+])
+def test_etag_matches(header):
+    etag = main.etag_for(1)
+    assert main.etag_matches(header.format(etag=etag), etag)
+
+
+@pytest.mark.parametrize("header", [None, "", '"other"', 'W/"other", "another"'])
+def test_etag_does_not_match(header):
+    assert not main.etag_matches(header, main.etag_for(1))
+
+
+# SSE framing
+
+def test_sse_event_single_line():
+    assert main.sse_event("hello") == "data: hello\n\n"
+
+
+def test_sse_event_prefixes_every_line():
+    assert main.sse_event("a\nb") == "data: a\ndata: b\n\n"
+
+
+# Chat write queue
+
+def test_enqueue_chat_drops_oldest_when_full(monkeypatch, caplog):
+    monkeypatch.setattr(main, "chat_write_queue", asyncio.Queue(maxsize=2))
+    for name in ("a", "b", "c"):
+        main.enqueue_chat({"username": name})
+
+    queued = [main.chat_write_queue.get_nowait()["username"] for _ in range(2)]
+    assert queued == ["b", "c"]
+    assert "dropped oldest message from a" in caplog.text
+
+
+def test_chat_writes_available():
+    assert not main.chat_writes_available()
+    main.worker_status["chat_flusher"] = "running"
+    assert main.chat_writes_available()
+    main.worker_status["chat_flusher"] = "restarting"
+    assert main.chat_writes_available()
+    main.worker_status["chat_flusher"] = "degraded"
+    assert not main.chat_writes_available()
+
+    main.worker_status["chat_flusher"] = "running"
+    main.chat_writes_closed.set()
+    assert not main.chat_writes_available()
+
+
+def test_flusher_requeues_unsent_rows_when_cancelled(monkeypatch):
+    inserted = []
+
+    async def fake_insert(table, rows):
+        inserted.append(rows)
+
+    monkeypatch.setattr(main, "sb_insert", fake_insert)
+
+    async def scenario():
+        main.enqueue_chat({"username": "a"})
+        task = asyncio.create_task(main.chat_flusher())
+        # Let it take the first row and start waiting for more
+        await asyncio.sleep(0.01)
+        task.cancel()
+        done, _ = await asyncio.wait({task}, timeout=1)
+        assert done
+
+    asyncio.run(scenario())
+    assert inserted == []
+    assert main.chat_write_queue.get_nowait() == {"username": "a"}
+
+
+def test_drain_stops_at_first_failure(monkeypatch, caplog):
+    calls = []
+
+    async def failing_insert(table, rows):
+        calls.append(rows)
+        raise RuntimeError("supabase down")
+
+    monkeypatch.setattr(main, "sb_insert", failing_insert)
+
+    async def scenario():
+        for i in range(120):
+            main.enqueue_chat({"username": str(i)})
+        loop = asyncio.get_running_loop()
+        await main.drain_chat_queue(loop.time() + 5)
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(scenario())
+    assert len(calls) == 1
+    assert "Abandoned 120 queued chat messages" in caplog.text
+
+
+# Worker supervision
+
+async def _no_sleep(delay):
+    pass
+
+
+def test_supervise_restarts_after_crash(monkeypatch):
+    monkeypatch.setattr(asyncio, "sleep", _no_sleep)
+    runs = []
+
+    async def worker():
+        runs.append(main.worker_status["w"])
+        if len(runs) == 1:
+            raise RuntimeError("boom")
+
+    asyncio.run(main.supervise("w", worker))
+    assert runs == ["running", "running"]
+    assert main.worker_status["w"] == "stopped"
+
+
+def test_supervise_gives_up_after_repeated_crashes(monkeypatch):
+    monkeypatch.setattr(asyncio, "sleep", _no_sleep)
+    runs = []
+
+    async def worker():
+        runs.append(1)
+        raise RuntimeError("boom")
+
+    asyncio.run(main.supervise("w", worker))
+    assert len(runs) == main.WORKER_MAX_FAILURES
+    assert main.worker_status["w"] == "degraded"
+
+
+@pytest.mark.parametrize("status, code", [
+    ("running", 200),
+    ("restarting", 200),
+    ("degraded", 503),
+    ("stopped", 503),
+])
+def test_health(status, code):
+    main.worker_status["chat_flusher"] = status
+    response = Response()
+    body = main.health(response)
+    assert response.status_code == code
+    assert body["status"] == ("ok" if code == 200 else "degraded")